@@ -5,13 +5,21 @@ Gold Pawnshop Web Application - Flask web interface for employees
 
 from flask import Flask, render_template, request, jsonify
 from datetime import datetime, timedelta
-import requests
-import traceback
 import os
 import json 
 import time
-import math
-import random
+import threading
+import queue
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+
+# fcntl is POSIX-only; without it the history file lock is per-process only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Flask will automatically find templates/ and static/ folders
 app = Flask(__name__)
@@ -42,6 +50,12 @@ KARAT_PURITY = {
     9: 0.375
 }
 
+# Precomputed lookups for the per-request rate calculation
+# (karat, purity, purity * 4) -- the last factor feeds the quarter rounding directly
+_KARAT_COEFFS = tuple((k, p, p * 4.0) for k, p in KARAT_PURITY.items())
+_KARATS_SORTED = sorted(KARAT_PURITY.keys(), reverse=True)
+_INV_TROY = 1.0 / TROY_OUNCE_TO_GRAMS
+
 # Business rules - Now configurable via admin panel
 # Default values (can be changed in admin panel)
 DEFAULT_CONFIG = {
@@ -62,83 +76,264 @@ DEFAULT_CONFIG = {
 
 # Configuration file paths
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config.json')
-PRICE_HISTORY_FILE = os.path.join(os.path.dirname(__file__), 'price_history.json')
+PRICE_HISTORY_FILE = os.path.join(os.path.dirname(__file__), 'price_history.jsonl')
+# Separate lock file: compaction replaces the history file's inode, so it can't hold the lock itself
+PRICE_HISTORY_LOCK_FILE = PRICE_HISTORY_FILE + '.lock'
+
+def _file_stamp(path):
+    """Return (mtime_ns, size) identifying the file's current contents, or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _atomic_write(path, text):
+    """Write text to path via a temp file + os.replace, so readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            # mkstemp creates the file as 0600; keep the permissions of the file we replace
+            try:
+                os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+            except OSError:
+                os.chmod(tmp_path, 0o644)
+            f.write(text)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Parsed config, re-read only when the file's stamp changes.
+# Stored as one (stamp, cfg) tuple so readers never see a stamp paired with the wrong config.
+_cfg_cache = {"entry": None}
 
 def load_config():
-    """Load configuration from file, or use defaults if file doesn't exist."""
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-                
-                # Recursive update for nested dictionaries (like volatility_margins)
-                for key, value in DEFAULT_CONFIG.items():
-                    if key not in config:
-                        config[key] = value
-                    elif isinstance(value, dict) and isinstance(config[key], dict):
-                        for sub_key, sub_val in value.items():
-                            if sub_key not in config[key]:
-                                config[key][sub_key] = sub_val
-                                
-                return config
-        except Exception as e:
-            app.logger.warning(f"Failed to load config: {e}, using defaults")
-            return DEFAULT_CONFIG.copy()
-    return DEFAULT_CONFIG.copy()
+    """
+    Load configuration from file, or use defaults if file doesn't exist.
+    The returned dict is shared and cached; copy it before modifying.
+    """
+    stamp = _file_stamp(CONFIG_FILE)
+    entry = _cfg_cache["entry"]
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    
+    config = _read_config_file() if stamp else DEFAULT_CONFIG.copy()
+    _cfg_cache["entry"] = (stamp, config)
+    return config
+
+def _read_config_file():
+    """Parse config.json and fill in any missing keys from DEFAULT_CONFIG."""
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+            
+            # Recursive update for nested dictionaries (like volatility_margins)
+            for key, value in DEFAULT_CONFIG.items():
+                if key not in config:
+                    config[key] = value
+                elif isinstance(value, dict) and isinstance(config[key], dict):
+                    for sub_key, sub_val in value.items():
+                        if sub_key not in config[key]:
+                            config[key][sub_key] = sub_val
+                            
+            return config
+    except Exception as e:
+        app.logger.warning(f"Failed to load config: {e}, using defaults")
+        return DEFAULT_CONFIG.copy()
 
 def save_config(config):
     """Save configuration to file."""
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=2)
+        _atomic_write(CONFIG_FILE, json.dumps(config, indent=2))
+        # Prime the cache with what we just wrote instead of re-reading it
+        _cfg_cache["entry"] = (_file_stamp(CONFIG_FILE), config)
         return True
     except Exception as e:
         app.logger.error(f"Failed to save config: {e}")
         return False
 
-# Load current configuration
-config = load_config()
-
 # ============================================================================
 # DYNAMIC PRICING LOGIC
 # ============================================================================
 
-def update_price_history(price_eur):
-    """Save the current price to history for volatility tracking."""
-    history = []
-    
-    # Load existing history
-    if os.path.exists(PRICE_HISTORY_FILE):
+# At most one sample per this many seconds (across all workers), so history size
+# is bounded by time rather than by request rate or how much the price moves
+HISTORY_MIN_INTERVAL = 300
+
+# Price history is stored as JSON Lines: one entry appended per price update,
+# with the file rewritten (compacted) only every so often.
+# Since samples are at least HISTORY_MIN_INTERVAL apart, this cap never cuts into the 14 days.
+HISTORY_MAX_ENTRIES = (14 * 24 * 3600) // HISTORY_MIN_INTERVAL
+HISTORY_COMPACT_EVERY = 100  # appends between compactions
+HISTORY_COMPACT_BYTES = 1024 * 1024  # well above a full, compacted file (~350KB)
+
+# Parsed price history, re-read only when the file's stamp changes.
+# Kept in memory as parallel timestamp/price arrays (oldest first) for vectorized stats.
+# "generation" is bumped whenever old samples are expired in memory without the file changing.
+_history_cache = {"stamp": None, "ts": np.empty(0), "price": np.empty(0), "appends": 0, "generation": 0}
+_history_lock = threading.RLock()
+
+@contextmanager
+def _history_file_lock():
+    """Serialize history appends/compactions across threads and gunicorn workers."""
+    with _history_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(PRICE_HISTORY_LOCK_FILE, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _trim_history(ts, prices):
+    """Drop entries older than 14 days and cap the arrays at HISTORY_MAX_ENTRIES."""
+    # Wall-clock on purpose: persisted timestamps must stay comparable across restarts
+    cutoff_time = time.time() - (14 * 24 * 3600)
+    keep = ts > cutoff_time
+    return ts[keep][-HISTORY_MAX_ENTRIES:], prices[keep][-HISTORY_MAX_ENTRIES:]
+
+def _read_history_file(path):
+    """Parse a JSON Lines history file into (timestamps, prices) arrays, skipping blank or corrupt lines."""
+    ts, prices = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                h = json.loads(line)
+                ts.append(float(h['timestamp']))
+                prices.append(float(h['price']))
+            except (ValueError, KeyError, TypeError):
+                app.logger.warning("Skipping corrupt price history line")
+    return np.array(ts, dtype=float), np.array(prices, dtype=float)
+
+def _history_line(ts, price_eur):
+    """Serialize one history entry as a JSON Lines record."""
+    return json.dumps({
+        "timestamp": ts,
+        "price": price_eur,
+        "date": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+    }) + "\n"
+
+def _load_history():
+    """Return the price history as (timestamps, prices), using the in-memory arrays when the file is unchanged."""
+    with _history_lock:
+        stamp = _file_stamp(PRICE_HISTORY_FILE)
+        if stamp == _history_cache["stamp"]:
+            # The file may go unwritten for a long time (e.g. during a Yahoo outage),
+            # so expire samples that have aged out of the 14-day window since loading
+            ts = _history_cache["ts"]
+            if ts.size and ts[0] <= time.time() - (14 * 24 * 3600):
+                _history_cache["ts"], _history_cache["price"] = _trim_history(ts, _history_cache["price"])
+                _history_cache["generation"] += 1
+            return _history_cache["ts"], _history_cache["price"]
+        if stamp is None:
+            _history_cache["stamp"] = None
+            _history_cache["ts"] = np.empty(0)
+            _history_cache["price"] = np.empty(0)
+            return _history_cache["ts"], _history_cache["price"]
+
         try:
-            with open(PRICE_HISTORY_FILE, 'r') as f:
-                history = json.load(f)
+            ts, prices = _trim_history(*_read_history_file(PRICE_HISTORY_FILE))
         except Exception as e:
             app.logger.warning(f"Failed to load price history: {e}")
-            history = []
-    
-    # Append new price with timestamp
-    history.append({
-        "timestamp": time.time(),
-        "price": price_eur,
-        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
-    
-    # Cleanup: Keep only last 14 days (approx 2 weeks)
-    # Assuming update every load, limit to ~500 entries to be safe
-    # Cleanup: Keep only last 14 days
-    cutoff_time = time.time() - (14 * 24 * 3600)
-    history = [h for h in history if h["timestamp"] > cutoff_time]
-    
-    # Provide a sort of limit if it gets too huge (e.g. 1000 entries)
-    if len(history) > 1000:
-        history = history[-1000:]
-        
-    # Save back
-    try:
-        with open(PRICE_HISTORY_FILE, 'w') as f:
-            json.dump(history, f)
-    except Exception as e:
-        app.logger.error(f"Failed to save price history: {e}")
+            ts, prices = np.empty(0), np.empty(0)
+
+        _history_cache["stamp"] = stamp
+        _history_cache["ts"] = ts
+        _history_cache["price"] = prices
+        return ts, prices
+
+def _compact_history():
+    """
+    Rewrite the history file keeping only the last 14 days / HISTORY_MAX_ENTRIES.
+    Must be called under _history_file_lock() so no other worker appends meanwhile.
+    """
+    ts, prices = _trim_history(*_read_history_file(PRICE_HISTORY_FILE))
+    _atomic_write(PRICE_HISTORY_FILE, "".join(_history_line(t, p) for t, p in zip(ts.tolist(), prices.tolist())))
+
+def _write_price_history(samples):
+    """Append a batch of (timestamp, price) samples to the history file."""
+    with _history_file_lock():
+        # Under the lock, so this includes every line other workers have written
+        ts, prices = _load_history()
+        
+        last_ts = float(ts[-1]) if ts.size else None
+        new_ts, new_prices = [], []
+        for sample_ts, price_eur in samples:
+            if last_ts is not None and sample_ts - last_ts < HISTORY_MIN_INTERVAL:
+                continue
+            new_ts.append(sample_ts)
+            new_prices.append(price_eur)
+            last_ts = sample_ts
+        
+        if not new_ts:
+            return
+            
+        # Append just the new lines; the 14-day cleanup is applied to disk in batches
+        try:
+            with open(PRICE_HISTORY_FILE, 'a') as f:
+                f.write("".join(_history_line(t, p) for t, p in zip(new_ts, new_prices)))
+            _history_cache["appends"] += len(new_ts)
+            
+            if (_history_cache["appends"] >= HISTORY_COMPACT_EVERY
+                    or os.path.getsize(PRICE_HISTORY_FILE) > HISTORY_COMPACT_BYTES):
+                _compact_history()
+                _history_cache["appends"] = 0
+        except Exception as e:
+            app.logger.error(f"Failed to save price history: {e}")
+        
+        # Re-read instead of assuming the in-memory arrays match what's on disk
+        _load_history()
+
+# History writes happen on a background thread so they stay off the request path.
+# The thread is started on first use (not at import) so each gunicorn worker gets its own.
+HISTORY_FLUSH_INTERVAL = 5  # seconds to collect samples before writing
+_history_queue = queue.Queue()
+_history_writer = {"thread": None, "pid": None}
+_history_writer_lock = threading.Lock()
+
+def _history_writer_loop():
+    """Collect queued samples for HISTORY_FLUSH_INTERVAL seconds, then write them in one go."""
+    while True:
+        batch = [_history_queue.get()]
+        deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_history_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _write_price_history(batch)
+        except Exception as e:
+            app.logger.error(f"Price history writer error: {e}")
+
+def _ensure_history_writer():
+    """Start the history writer thread for this process if it isn't running."""
+    if _history_writer["pid"] == os.getpid():
+        return
+    with _history_writer_lock:
+        if _history_writer["pid"] != os.getpid():
+            thread = threading.Thread(target=_history_writer_loop, name="price-history-writer", daemon=True)
+            thread.start()
+            _history_writer["thread"] = thread
+            _history_writer["pid"] = os.getpid()
+
+def update_price_history(price_eur):
+    """Queue the current price for the history file (used for volatility tracking)."""
+    _ensure_history_writer()
+    _history_queue.put((time.time(), price_eur))
+
+# Last volatility result, valid until the history (file or expired samples) or thresholds change
+_vol_cache = {"key": None, "result": ('medium', 0.0, {})}
 
 def calculate_volatility_state():
     """
@@ -146,83 +341,163 @@ def calculate_volatility_state():
     Returns: (state, volatility_percent, details_dict)
     state: 'low', 'medium', 'high'
     """
-    if not os.path.exists(PRICE_HISTORY_FILE):
-        return 'medium', 0.0, {} # Default to medium if no data
-        
     try:
-        with open(PRICE_HISTORY_FILE, 'r') as f:
-            history = json.load(f)
-            
-        # Filter for last 14 days
-        cutoff_time = time.time() - (14 * 24 * 3600)
-        recent_prices = [h['price'] for h in history if h['timestamp'] > cutoff_time]
-        
-        if len(recent_prices) < 2:
-            return 'medium', 0.0, {"msg": "insufficient_data"}
-            
-        min_price = min(recent_prices)
-        max_price = max(recent_prices)
-        avg_price = sum(recent_prices) / len(recent_prices)
-        
-        # Volatility formula: (Max - Min) / Average
-        volatility = ((max_price - min_price) / avg_price) * 100
-        
-        # Determine State
-        thresholds = config.get('volatility_thresholds', DEFAULT_CONFIG['volatility_thresholds'])
-        
-        if volatility < thresholds['low_limit']:
-            state = 'low'
-        elif volatility > thresholds['high_limit']:
-            state = 'high'
-        else:
-            state = 'medium'
+        thresholds = load_config().get('volatility_thresholds', DEFAULT_CONFIG['volatility_thresholds'])
+        
+        with _history_lock:
+            # _load_history() stats the file, so its stamp doubles as our cache key
+            ts, prices = _load_history()
+            key = (_history_cache["stamp"], _history_cache["generation"],
+                   thresholds['low_limit'], thresholds['high_limit'])
+            if key == _vol_cache["key"]:
+                return _vol_cache["result"]
             
-        return state, volatility, {
-            "min": min_price, 
-            "max": max_price, 
-            "avg": avg_price,
-            "count": len(recent_prices)
-        }
+            result = _compute_volatility_state(ts, prices, thresholds)
+            _vol_cache["key"] = key
+            _vol_cache["result"] = result
+            return result
             
     except Exception as e:
         app.logger.error(f"Error calculating volatility: {e}")
         return 'medium', 0.0, {}
 
+def _compute_volatility_state(timestamps, prices, thresholds):
+    """Classify the 14-day volatility of the timestamp/price arrays against the thresholds."""
+    if prices.size == 0:
+        return 'medium', 0.0, {} # Default to medium if no data
+        
+    # Filter for last 14 days (wall-clock, to match the persisted timestamps)
+    cutoff_time = time.time() - (14 * 24 * 3600)
+    recent_prices = prices[timestamps > cutoff_time]
+    count = int(recent_prices.size)
+    
+    if count < 2:
+        return 'medium', 0.0, {"msg": "insufficient_data"}
+        
+    min_price = float(recent_prices.min())
+    max_price = float(recent_prices.max())
+    avg_price = float(recent_prices.mean())
+    
+    # Volatility formula: (Max - Min) / Average
+    volatility = ((max_price - min_price) / avg_price) * 100
+    
+    # Determine State
+    if volatility < thresholds['low_limit']:
+        state = 'low'
+    elif volatility > thresholds['high_limit']:
+        state = 'high'
+    else:
+        state = 'medium'
+        
+    return state, volatility, {
+        "min": min_price, 
+        "max": max_price, 
+        "avg": avg_price,
+        "count": count
+    }
+
 # ============================================================================
 # FUNCTIONS (from gold_pawn_agent.py)
 # ============================================================================
 
-# Robust import for yfinance
-try:
-    import yfinance as yf
-except (ImportError, TypeError, Exception) as e:
-    logging.warning(f"Failed to import yfinance: {e}")
-    yf = None
+# yfinance (and pandas with it) is imported lazily on the first live fetch,
+# so startup and cache-hit requests don't pay for it. Under gunicorn --preload,
+# gunicorn.conf.py imports it in the master instead so workers share it.
+_yf = None
+_yf_failed = False
+_tickers = {}
+
+# The gold and EUR/USD lookups are independent, so they run side by side
+_fetch_pool = ThreadPoolExecutor(max_workers=2)
+YF_FETCH_TIMEOUT = 5  # seconds
+
+def _get_yfinance():
+    """Robust lazy import for yfinance. Returns the module, or None if unavailable."""
+    global _yf, _yf_failed
+    if _yf is None and not _yf_failed:
+        try:
+            import yfinance
+            _yf = yfinance
+        except (ImportError, TypeError, Exception) as e:
+            logging.warning(f"Failed to import yfinance: {e}")
+            _yf_failed = True
+    return _yf
+
+def _get_ticker(yf, symbol):
+    """Return a cached yf.Ticker for the symbol, creating it on first use."""
+    ticker = _tickers.get(symbol)
+    if ticker is None:
+        ticker = _tickers[symbol] = yf.Ticker(symbol)
+    return ticker
+
+# Short-lived cache so page loads within the TTL reuse one Yahoo fetch.
+# Ages are measured with time.monotonic() so clock adjustments can't stretch or skip the TTL.
+_PRICE_TTL = 60  # seconds
+# After a failed fetch, serve the fallback for this long instead of retrying,
+# so requests queued on the lock during an outage don't each redo the fetch
+_PRICE_FAIL_TTL = 10  # seconds
+FALLBACK_PRICE = 3900.0
+_price_cache = {"price": None, "ts": 0.0, "failed_ts": None}
+_price_lock = threading.Lock()
+
+def _cached_price():
+    """Return the cached live price, the fallback during a recent failure, or None if a fetch is due."""
+    now = time.monotonic()
+    if _price_cache["price"] and now - _price_cache["ts"] < _PRICE_TTL:
+        return _price_cache["price"]
+    if _price_cache["failed_ts"] is not None and now - _price_cache["failed_ts"] < _PRICE_FAIL_TTL:
+        return FALLBACK_PRICE
+    return None
 
 def fetch_gold_price():
     """
     Fetch current XAUEUR (gold price per troy ounce in EUR) using Yahoo Finance.
+    Live prices are cached for _PRICE_TTL seconds, failures for _PRICE_FAIL_TTL.
     """
+    price = _cached_price()
+    if price is not None:
+        return price
+
+    # Only one thread refetches; the rest wait and reuse its result
+    with _price_lock:
+        price = _cached_price()
+        if price is not None:
+            return price
+        return _fetch_gold_price_uncached()
+
+def _fetch_gold_price_uncached():
+    """Fetch the live price from Yahoo Finance, falling back to a static price."""
     try:
         price_eur = None
         
         # Only try Yahoo Finance if module loaded successfully
+        yf = _get_yfinance()
         if yf:
             try:
                 # Yahoo Finance Ticker for Gold in EUR
                 # Strategy: Get Gold (USD) and USD/EUR rate from Yahoo
-                gold_ticker = yf.Ticker("GC=F")
-                gold_data = gold_ticker.history(period="1d")
+                gold_ticker = _get_ticker(yf, "GC=F")
+                usd_eur_ticker = _get_ticker(yf, "EUR=X")
                 
-                usd_eur_ticker = yf.Ticker("EUR=X") 
-                forex_data = usd_eur_ticker.history(period="1d")
+                # history()'s own timeout makes a stuck request give its pool slot back;
+                # wait() puts both lookups under one shared deadline
+                gold_future = _fetch_pool.submit(gold_ticker.history, period="1d", timeout=YF_FETCH_TIMEOUT)
+                forex_future = _fetch_pool.submit(usd_eur_ticker.history, period="1d", timeout=YF_FETCH_TIMEOUT)
+                _, pending = wait([gold_future, forex_future], timeout=YF_FETCH_TIMEOUT)
+                if pending:
+                    raise TimeoutError(f"no response within {YF_FETCH_TIMEOUT}s")
+                gold_data = gold_future.result()
+                forex_data = forex_future.result()
                 
                 if not gold_data.empty and not forex_data.empty:
-                    # Get latest closing price
-                    gold_usd = gold_data['Close'].iloc[-1]
-                    eur_rate = forex_data['Close'].iloc[-1]
+                    # Get latest closing price (read from the raw array to skip Series boxing)
+                    gold_usd = float(gold_data['Close'].values[-1])
+                    eur_rate = float(forex_data['Close'].values[-1])
                     
                     price_eur = gold_usd * eur_rate
+                    _price_cache["price"] = price_eur
+                    _price_cache["ts"] = time.monotonic()
+                    _price_cache["failed_ts"] = None
                     app.logger.info(f"YFinance Live: Gold ${gold_usd:.2f} | Rate {eur_rate:.4f} | Price €{price_eur:.2f}")
                     
                 else:
@@ -233,73 +508,102 @@ def fetch_gold_price():
         # Fallback if Yahoo fails (Unlikely) or yf not available
         if price_eur is None:
             # STATIC fallback 
-            price_eur = 3900.0
+            price_eur = FALLBACK_PRICE
+            _price_cache["failed_ts"] = time.monotonic()
             app.logger.warning(f"Using static fallback gold price: €{price_eur:.2f}")
 
         # Update History
-        # Only update history if the price looks "real" (not exactly 3900.0 unless that's real)
+        # Only update history if the price looks "real" (not exactly the fallback unless that's real)
         # To avoid polluting history with fallback static data
-        if abs(price_eur - 3900.0) > 0.01: 
+        if abs(price_eur - FALLBACK_PRICE) > 0.01: 
              update_price_history(price_eur)
         
         return price_eur
 
     except Exception as e:
         app.logger.error(f"Critical error fetching gold price: {e}")
-        return 3900.0
+        _price_cache["failed_ts"] = time.monotonic()
+        return FALLBACK_PRICE
 
 
 def get_current_margin_percentage():
     """Determine the current margin % based on volatility."""
     state, volatility, _ = calculate_volatility_state()
-    margins = config.get('volatility_margins', DEFAULT_CONFIG['volatility_margins'])
+    margins = load_config().get('volatility_margins', DEFAULT_CONFIG['volatility_margins'])
     
     # Select margin based on state
     margin_percent = margins.get(state, margins['medium'])
     
     return margin_percent, state, volatility
 
-def calculate_rates(xaueur_price):
-    """Calculate buy/pawn price per gram for each karat using Dynamic Pricing."""
+def calculate_rates(xaueur_price, margin_info=None):
+    """
+    Calculate buy/pawn price per gram for each karat using Dynamic Pricing.
+    margin_info: optional (margin_percent, state, volatility) from get_current_margin_percentage()
+    Returns: (rates, meta) where meta holds the volatility info for UI display
+    """
     
     # 1. Get Dynamic Margin
-    margin_percent, volatility_state, volatility_val = get_current_margin_percentage()
+    if margin_info is None:
+        margin_info = get_current_margin_percentage()
+    margin_percent, volatility_state, volatility_val = margin_info
     
     # Convert margin to discount rate (e.g., 6% margin -> 0.94 multiplier)
     discount_rate = 1.0 - (margin_percent / 100.0)
     
     app.logger.info(f"Dynamic Pricing Active: State={volatility_state}, Volatility={volatility_val:.2f}%, Margin={margin_percent}%")
     
-    price_per_gram_eur = xaueur_price / TROY_OUNCE_TO_GRAMS
+    price_per_gram_eur = xaueur_price * _INV_TROY
+    buy_price_per_gram_eur = price_per_gram_eur * discount_rate
     
     rates = {}
-    for karat, purity_factor in KARAT_PURITY.items():
+    for karat, purity_factor, purity_x4 in _KARAT_COEFFS:
         melt_value_per_gram = price_per_gram_eur * purity_factor
-        raw_buy_price = melt_value_per_gram * discount_rate
         
         # NEW: Round to nearest 0.25 (Quarter Logic) to match user preference
-        # 28.18 -> 28.25, 28.10 -> 28.00
-        buy_pawn_price_per_gram = round(raw_buy_price * 4) / 4
+        # 28.18 -> 28.25, 28.10 -> 28.00 (ties round up; prices are always positive)
+        buy_pawn_price_per_gram = int(buy_price_per_gram_eur * purity_x4 + 0.5) * 0.25
         
         rates[karat] = {
             "melt_value": melt_value_per_gram,
             "buy_pawn_price": buy_pawn_price_per_gram
         }
     
-    # Return extra metadata for UI display
-    rates['_meta'] = {
+    # Extra metadata for UI display
+    meta = {
         "volatility_state": volatility_state,
         "volatility_percent": volatility_val,
         "active_margin": margin_percent
     }
     
-    return rates
+    return rates, meta
+
+
+# Last computed rate sheet, keyed on price and the margin/volatility it was built with
+_rates_cache = {"key": None, "value": None}
+_rates_lock = threading.Lock()
+
+def get_rates_cached(xaueur_price):
+    """
+    Return calculate_rates() for this price, reusing the last result while the
+    price and the current margin/volatility are unchanged.
+    The returned dicts are shared between requests and must not be mutated.
+    """
+    # Volatility is itself cached, so keying on it stays cheap and picks up
+    # config changes as well as samples expiring from the 14-day window
+    margin_info = get_current_margin_percentage()
+    key = (round(xaueur_price, 2),) + margin_info
+    with _rates_lock:
+        if key != _rates_cache["key"]:
+            _rates_cache["value"] = calculate_rates(xaueur_price, margin_info)
+            _rates_cache["key"] = key
+        return _rates_cache["value"]
 
 
 def calculate_loan(karat, weight_in_grams, rates, interest_rate=None):
     """Calculate loan amount, interest, and total due."""
     if interest_rate is None:
-        interest_rate = config.get('interest_rate', DEFAULT_CONFIG['interest_rate'])
+        interest_rate = load_config().get('interest_rate', DEFAULT_CONFIG['interest_rate'])
     
     buy_pawn_price_per_gram = rates[karat]["buy_pawn_price"]
     melt_value_per_gram = rates[karat]["melt_value"]
@@ -338,6 +642,7 @@ def index():
         if xaueur_price is None:
             # Use fallback price if API fails
             try:
+                import requests  # only needed on this rare path
                 eur_response = requests.get(EUR_USD_API_URL, timeout=5)
                 eur_data = eur_response.json()
                 eur_usd_rate = float(eur_data.get("rates", {}).get("EUR", 0.92))
@@ -347,23 +652,18 @@ def index():
                 xaueur_price = 3864.0  # Approximate fallback
         
         # Calculate rates for all karats
-        rates = calculate_rates(xaueur_price)
-        
-        # Extract meta info if present
-        meta_info = rates.pop('_meta', None)
-        
-        # Prepare karats list
-        karats_list = sorted(KARAT_PURITY.keys(), reverse=True)
+        rates, meta_info = get_rates_cached(xaueur_price)
         
         return render_template('index.html', 
                              xaueur_price=xaueur_price,
                              rates=rates,
-                             karats=karats_list,
+                             karats=_KARATS_SORTED,
                              meta_info=meta_info,
-                             is_fallback=False if xaueur_price != 3900.0 else True)
+                             is_fallback=False if xaueur_price != FALLBACK_PRICE else True)
 
     except Exception as e:
         error_msg = str(e)
+        import traceback
         error_trace = traceback.format_exc()
         app.logger.error(f"Error in index route: {error_msg}")
         app.logger.error(error_trace)
@@ -390,7 +690,7 @@ def calculate():
             xaueur_price = 3864.0 # Roughly €4200 USD equivalent
         
         # Calculate rates
-        rates = calculate_rates(xaueur_price)
+        rates, _ = get_rates_cached(xaueur_price)
         
         # Calculate loan
         loan_info = calculate_loan(karat, weight, rates)
@@ -411,8 +711,7 @@ def api_rates():
         if xaueur_price is None:
              xaueur_price = 3864.0
         
-        rates = calculate_rates(xaueur_price)
-        meta_info = rates.pop('_meta', None)
+        rates, meta_info = get_rates_cached(xaueur_price)
         
         return jsonify({
             "xaueur_price": xaueur_price,
@@ -477,8 +776,8 @@ def update_config():
         # Convert interest percentage to rate
         interest_rate = interest_percent / 100
         
-        # Update config object
-        current_config = load_config()
+        # Update a copy of the config so the cached one stays intact if saving fails
+        current_config = dict(load_config())
         current_config['interest_rate'] = interest_rate
         current_config['shop_name'] = shop_name
         
@@ -491,10 +790,6 @@ def update_config():
         
         # Save
         if save_config(current_config):
-            # Reload global config
-            global config
-            config = load_config()
-            
             return jsonify({
                 "success": True,
                 "message": "Dynamic Pricing Strategy updated!",
@@ -509,22 +804,31 @@ def update_config():
         return jsonify({"error": str(e)}), 500
 
 
-@app.errorhandler(500)
-def internal_error(error):
-    """Handle 500 errors with detailed information."""
-    error_trace = traceback.format_exc()
-    app.logger.error(f"Internal Server Error: {error}")
-    app.logger.error(error_trace)
-    return f"""
+# Static body for 500 responses; details go to the logs only
+_ERROR_HTML = """
     <html>
     <head><title>Internal Server Error</title></head>
     <body style="font-family: Arial; padding: 40px;">
         <h1>Internal Server Error</h1>
         <p>The server encountered an error. Check Render logs for details.</p>
-        <pre style="background: #f5f5f5; padding: 20px;">{error_trace}</pre>
     </body>
     </html>
-    """, 500
+    """
+
+@app.errorhandler(500)
+def internal_error(error):
+    """Handle 500 errors: log the traceback, return a static page."""
+    import traceback
+    app.logger.error(f"Internal Server Error: {error}")
+    app.logger.error(traceback.format_exc())
+    return _ERROR_HTML, 500
+
+
+# Warm the caches at import time. With gunicorn --preload this runs once in the
+# master, and the workers inherit the parsed config and history after the fork.
+# (gunicorn.conf.py also pre-imports yfinance in that case.)
+load_config()
+calculate_volatility_state()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,9 @@
+"""
+Gunicorn settings - picked up automatically when gunicorn starts in this folder
+"""
+
+def on_starting(server):
+    """With --preload, import yfinance in the master so all workers share it copy-on-write."""
+    if server.cfg.preload_app:
+        import app
+        app._get_yfinance()